@@ -8,12 +8,185 @@ agent's state (Kripke model), reasoning (modal logic), and interaction with the
 LLM. It also defines the specific configurations for each type of agent used
 in the simulation (e.g., RF_Agent, Cooling_Agent).
 """
-import ollama
-import json
+import asyncio
+import logging
+import os
+import numpy as np
+import orjson
 from itertools import combinations
+from types import MappingProxyType
 from modal_logic import KripkeModel, ModalParser
 from knowledge import LatticeModel, LATTICE_LAYOUT
 from expert_rules import EXPERT_RULES  # Import the expert rules
+from llm_backend import shared_backend
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of in-flight LLM requests. Should match the Ollama server's
+# OLLAMA_NUM_PARALLEL setting so concurrent agents don't just queue server-side.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+_LLM_SEMAPHORE = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+# Agents monitoring at least this many PVs check their thresholds with NumPy instead of a Python loop.
+_VECTORIZED_THRESHOLD_MIN_PVS = 8
+
+_HYPOTHESIS_SYS_PROMPT = """
+You are an expert accelerator physicist. Based on an anomaly report, you must hypothesize the likely upstream cause.
+Your response MUST be a JSON object with one key: "suspected_system", which should be one of the following:
+'Cooling', 'Power', 'Vacuum', 'Klystron', 'Magnet', 'Beam Instability', or 'Unknown'.
+Example: If the report is about high RF cavity temperature, the suspected system is 'Cooling'.
+Example: If the report is about low RF forward power, the suspected system is 'Klystron'.
+"""
+
+# The batched variant keeps the single-report instructions as a prefix and only
+# changes the expected output shape to one entry per numbered report.
+_BATCH_HYPOTHESIS_SYS_PROMPT = _HYPOTHESIS_SYS_PROMPT + """
+You will receive several numbered anomaly reports at once. Instead of a single object, respond with a JSON object
+with one key: "hypotheses", a list containing one entry per report of the form {"idx": <report number>, "suspected_system": <system>}.
+"""
+
+_THEORY_SYS_PROMPT = """
+You are a master diagnostics engine for a particle accelerator. Based on the following agent reports,
+determine the most likely causal chain. Use the provided physical connection context to determine the correct
+causal direction (a component providing a service is the upstream cause). Your response MUST be a JSON object
+with three keys:
+"root_cause_agent": The name of the agent reporting the root cause.
+"symptom_agent": The name of the agent reporting the downstream symptom.
+"causal_theory": A brief, human-readable explanation of the failure chain.
+"""
+
+_UPDATE_SYS_PROMPT = """
+You are a precise reasoning engine. Your task is to update a Kripke model based on new, definitive information.
+You MUST prune worlds and relations that are now impossible.
+Respond ONLY with the complete, updated Kripke model in a single JSON object.
+The 'valuations' property must be a dictionary where each value is a LIST OF STRINGS.
+"""
+
+# The system prompts above are constant, so every request starts with a byte-identical
+# prefix that the server can serve from its KV cache. Keeping the model loaded and
+# pinning the system tokens ('num_keep', roughly 4 characters per token) stops that
+# cached prefix from being evicted between simulation ticks.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "24h")
+
+# Generation budgets sized to the replies we expect: the hypothesis and theory calls
+# return a few dozen tokens of JSON, so a small context and token cap keep the KV cache
+# and decode time short. Greedy decoding makes the JSON output reproducible.
+_GREEDY = {'temperature': 0.0, 'top_k': 1}
+_HYPOTHESIS_OPTIONS = {**_GREEDY, 'num_predict': 32, 'num_ctx': 1024,
+                       'num_keep': len(_HYPOTHESIS_SYS_PROMPT) // 4}
+_BATCH_HYPOTHESIS_OPTIONS = {**_GREEDY, 'num_predict': 256, 'num_ctx': 2048,
+                             'num_keep': len(_BATCH_HYPOTHESIS_SYS_PROMPT) // 4}
+_THEORY_OPTIONS = {**_GREEDY, 'num_predict': 128, 'num_ctx': 1024,
+                   'num_keep': len(_THEORY_SYS_PROMPT) // 4}
+_UPDATE_OPTIONS = {**_GREEDY, 'num_predict': 256, 'num_ctx': 4096,
+                   'num_keep': len(_UPDATE_SYS_PROMPT) // 4}
+
+# Static mappings between the reporting agents and the lattice. They never change at
+# runtime, so they are built once here rather than on every diagnosis.
+_AGENT_TO_COMPONENT = MappingProxyType({
+    "Cooling_Agent": "COOL:primary_loop",
+    "Klystron_Agent": "RF:klystron",
+    "RF_Agent": "RF:cavity",
+    "Vacuum_Agent": "VAC:sector1_pump"
+})
+_AGENT_TO_PV = MappingProxyType({
+    "Cooling_Agent": "COOL:valve_position",
+    "Klystron_Agent": "RF:klystron_output",
+    "RF_Agent": "RF:cavity",
+    "Vacuum_Agent": "VAC:sector1_pump:pressure"
+})
+_CONN_TYPE = MappingProxyType({
+    "Cooling_Agent": "cooling",
+    "Klystron_Agent": "power"
+})
+
+
+def _lattice_key(agent_name):
+    """
+    Returns the string an agent is identified by in lattice connection checks, or None if it has none.
+    The same string is passed as the upstream sensor PV (which the lattice maps to its owning component)
+    and, unchanged, as the downstream component name; RF_Agent's entry is therefore the component 'RF:cavity'.
+    """
+    return _AGENT_TO_PV.get(agent_name)
+
+
+# Components each lattice component provides a service to, as sets for O(1) membership tests.
+_SERVICES_OF = MappingProxyType({name: details.get("services", frozenset()) for name, details in LATTICE_LAYOUT.items()})
+
+
+def _build_causal_context(services_of):
+    """
+    Precomputes the lattice context handed to the LLM for every group of at least two reporting agents.
+    Keys are frozensets of agent names; groups whose components share no service link are omitted.
+    """
+    causal_context = {}
+    agent_names = list(_AGENT_TO_COMPONENT)
+    for group_size in range(2, len(agent_names) + 1):
+        for group in combinations(agent_names, group_size):
+            components = [_AGENT_TO_COMPONENT[agent] for agent in group]
+            context_lines = [
+                f"- The '{upstream}' component provides a service to the '{downstream}' component."
+                for comp1_name, comp2_name in combinations(components, 2)
+                for upstream, downstream in ((comp1_name, comp2_name), (comp2_name, comp1_name))
+                if downstream in services_of.get(upstream, ())
+            ]
+            if context_lines:
+                causal_context[frozenset(group)] = "\n".join(
+                    ["For context, here are the known physical connections which imply causal direction:", *context_lines])
+    return causal_context
+
+
+_CAUSAL_CONTEXT = _build_causal_context(_SERVICES_OF)
+
+# JSON schemas for constrained decoding: the server can only produce replies of this shape,
+# so they always parse and 'suspected_system' is always one of the known systems.
+_SUSPECTED_SYSTEMS = ["Cooling", "Power", "Vacuum", "Klystron", "Magnet", "Beam Instability", "Unknown"]
+_HYPOTHESIS_SCHEMA = {
+    "type": "object",
+    "properties": {"suspected_system": {"enum": _SUSPECTED_SYSTEMS}},
+    "required": ["suspected_system"]
+}
+_BATCH_HYPOTHESIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "hypotheses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"idx": {"type": "integer"}, "suspected_system": {"enum": _SUSPECTED_SYSTEMS}},
+                "required": ["idx", "suspected_system"]
+            }
+        }
+    },
+    "required": ["hypotheses"]
+}
+_THEORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "root_cause_agent": {"type": "string"},
+        "symptom_agent": {"type": "string"},
+        "causal_theory": {"type": "string"}
+    },
+    "required": ["root_cause_agent", "symptom_agent", "causal_theory"]
+}
+_UPDATE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "worlds": {"type": "array", "items": {"type": "string"}},
+        "relations": {"type": "array", "items": {"type": "array", "items": {"type": "string"}}},
+        "valuations": {"type": "object", "additionalProperties": {"type": "array", "items": {"type": "string"}}},
+        "current_world": {"type": "string"}
+    },
+    "required": ["worlds", "relations", "valuations", "current_world"]
+}
+
+
+async def preload_model(backend, model):
+    """Loads the model into server memory ahead of the first tick so it stays resident for the whole run."""
+    try:
+        await backend.preload(model, keep_alive=OLLAMA_KEEP_ALIVE)
+    except Exception as e:
+        logger.warning("Could not preload model '%s' on the LLM backend: %s", model, e)
 
 
 class NeuroSymbolicAgent:
@@ -22,104 +195,189 @@ class NeuroSymbolicAgent:
     LLM to interpret new information and generate causal hypotheses.
     """
 
-    def __init__(self, name, model, kripke_model, monitored_pvs, thresholds, knowledge_base=None, expert_rules=None):
+    def __init__(self, name, model, kripke_model, monitored_pvs, thresholds, knowledge_base=None, expert_rules=None,
+                 backend=None):
         self.name = name
         self.model = model
-        self.client = ollama.Client()
+        self.backend = backend or shared_backend()
         self.kripke_model = kripke_model
         self.monitored_pvs = monitored_pvs
         self.thresholds = thresholds
+        # Thresholds as parallel arrays (PV names, lower and upper bounds) for the vectorized check.
+        self._pv_names = tuple(thresholds)
+        self._lows = np.fromiter((low for low, _ in thresholds.values()), dtype=np.float64, count=len(thresholds))
+        self._highs = np.fromiter((high for _, high in thresholds.values()), dtype=np.float64, count=len(thresholds))
         self.modal_parser = ModalParser()
         self.logbook = []
         self.explanations = []
         self.knowledge_base = knowledge_base
         self.expert_rules = expert_rules
-        print(f"--- Agent {self.name} Initialized ---")
+        # Expert rules never change, so they are parsed and compiled to closures once.
+        self._compiled_rules = [(rule, self.modal_parser.compile(rule)) for rule in expert_rules or []]
+        # LLM answers reused across ticks: hypotheses keyed by (pv, breach direction),
+        # causal theories keyed by the reporting agents, their suspicions and the lattice context.
+        self._hypothesis_cache = {}
+        self._theory_cache = {}
+        logger.info("--- Agent %s Initialized ---", self.name)
         if self.expert_rules:
             self.log(f"Loaded {len(self.expert_rules)} expert rules.")
         self.print_kb()
 
     def log(self, message):
-        """Prints a formatted log message for the agent."""
-        print(f"[{self.name} LOG]: {message}")
-
-    def print_kb(self):
-        """Prints the agent's current knowledge base (Kripke model)."""
-        print(f"[{self.name}'s Kripke Model (Current World: {self.kripke_model.current_world})]:")
-        print(json.dumps(self.kripke_model.to_dict(), indent=2))
-        print("-" * 30)
-
-    def check_signals(self, epics_state):
+        """Logs a formatted message for the agent."""
+        logger.info("[%s LOG]: %s", self.name, message)
+
+    def print_kb(self, level=logging.DEBUG):
+        """Logs the agent's current knowledge base (Kripke model); it is only serialized if `level` is enabled."""
+        if not logger.isEnabledFor(level):
+            return
+        logger.log(level, "[%s's Kripke Model (Current World: %s)]:\n%s\n%s",
+                   self.name, self.kripke_model.current_world,
+                   orjson.dumps(self.kripke_model.to_dict(), option=orjson.OPT_INDENT_2).decode(), "-" * 30)
+
+    def detect_anomaly(self, epics_state):
         """
-        Monitors assigned EPICS signals and generates a report if a threshold is breached.
+        Checks assigned EPICS signals against their thresholds without consulting the LLM.
+        Returns a dictionary describing the first breached PV, or None if all signals are nominal.
         """
+        if len(self._pv_names) >= _VECTORIZED_THRESHOLD_MIN_PVS:
+            # PVs missing from the state are skipped; any present value (NaN included) outside
+            # the open interval (low, high) is a breach, exactly as in the loop below.
+            present = np.fromiter((pv in epics_state for pv in self._pv_names),
+                                  dtype=bool, count=len(self._pv_names))
+            values = np.fromiter((epics_state.get(pv, np.nan) for pv in self._pv_names),
+                                 dtype=np.float64, count=len(self._pv_names))
+            breached = present & ~((self._lows < values) & (values < self._highs))
+            idx = int(np.argmax(breached))
+            if not breached[idx]:
+                return None
+            pv = self._pv_names[idx]
+            low, high = self.thresholds[pv]
+            return self._breach(pv, epics_state[pv], low, high)
+
         for pv, (low, high) in self.thresholds.items():
             if pv in epics_state:
                 value = epics_state[pv]
                 if not (low < value < high):
-                    anomaly_report = f"Anomaly detected on {pv}. Value is {value}, which is outside the normal range ({low}, {high})."
-                    self.log(f"Threshold breached for {pv}. Value: {value}")
-                    hypothesis = self._generate_hypothesis(anomaly_report)
-                    return {"anomaly_report": anomaly_report, **hypothesis}
+                    return self._breach(pv, value, low, high)
         return None
 
-    def _generate_hypothesis(self, report):
+    def _breach(self, pv, value, low, high):
+        """Logs a threshold breach and describes it as returned by `detect_anomaly`."""
+        anomaly_report = f"Anomaly detected on {pv}. Value is {value}, which is outside the normal range ({low}, {high})."
+        self.log(f"Threshold breached for {pv}. Value: {value}")
+        direction = 'high' if value >= high else 'low'
+        return {"pv": pv, "value": value, "direction": direction, "anomaly_report": anomaly_report}
+
+    async def check_signals(self, epics_state):
+        """
+        Monitors assigned EPICS signals and generates a report if a threshold is breached.
+        """
+        anomaly = self.detect_anomaly(epics_state)
+        if not anomaly:
+            return None
+        hypothesis, = await self.hypotheses_for_anomalies([anomaly])
+        return {"anomaly_report": anomaly["anomaly_report"], **hypothesis}
+
+    async def hypotheses_for_anomalies(self, anomalies):
+        """
+        Returns one hypothesis per anomaly (as produced by `detect_anomaly`), asking the LLM only about
+        breaches not seen before. A PV that stays out of range in the same direction keeps its hypothesis.
+        """
+        keys = [(anomaly["pv"], anomaly["direction"]) for anomaly in anomalies]
+        misses = [i for i, key in enumerate(keys) if key not in self._hypothesis_cache]
+        if len(misses) < len(keys):
+            self.log(f"Reusing cached hypotheses for {len(keys) - len(misses)} known breach(es).")
+
+        hypotheses = {i: self._hypothesis_cache.get(key) for i, key in enumerate(keys)}
+        if misses:
+            generated = await self.batch_generate_hypotheses([anomalies[i]["anomaly_report"] for i in misses])
+            for i, hypothesis in zip(misses, generated):
+                hypotheses[i] = hypothesis
+                # 'Unknown' may stem from a transient LLM failure, so it is asked again next time.
+                if hypothesis.get("suspected_system", "Unknown") != "Unknown":
+                    self._hypothesis_cache[keys[i]] = hypothesis
+        return [hypotheses[i] for i in range(len(keys))]
+
+    async def _generate_hypothesis(self, report):
         """Uses LLM to generate a hypothesis about the root cause of an anomaly."""
         self.log("Generating causal hypothesis with LLM...")
-        system_prompt = """
-        You are an expert accelerator physicist. Based on an anomaly report, you must hypothesize the likely upstream cause.
-        Your response MUST be a JSON object with one key: "suspected_system", which should be one of the following:
-        'Cooling', 'Power', 'Vacuum', 'Klystron', 'Magnet', 'Beam Instability', or 'Unknown'.
-        Example: If the report is about high RF cavity temperature, the suspected system is 'Cooling'.
-        Example: If the report is about low RF forward power, the suspected system is 'Klystron'.
-        """
         prompt = f"Anomaly Report: '{report}'. What is the suspected upstream system?"
         try:
-            response = self.client.chat(
-                model=self.model,
-                messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}],
-                format='json'
-            )
-            raw_content = response['message']['content']
-            hypothesis = json.loads(raw_content)
+            async with _LLM_SEMAPHORE:
+                hypothesis = await self.backend.chat_json(
+                    self.model, [{'role': 'system', 'content': _HYPOTHESIS_SYS_PROMPT}, {'role': 'user', 'content': prompt}],
+                    options=_HYPOTHESIS_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE, schema=_HYPOTHESIS_SCHEMA
+                )
             self.log(f"LLM Hypothesis: {hypothesis}")
             return hypothesis
-        except (json.JSONDecodeError, KeyError) as e:
+        except orjson.JSONDecodeError as e:
+            # Still possible despite the schema: the reply may be cut off by 'num_predict'.
             self.log(f"FATAL ERROR parsing LLM hypothesis response. Error: {e}")
             return {"suspected_system": "Unknown"}
         except Exception as e:
-            self.log(f"A connection error occurred with Ollama: {e}")
+            self.log(f"A connection error occurred with the LLM backend: {e}")
             return {"suspected_system": "Unknown"}
 
+    async def batch_generate_hypotheses(self, reports):
+        """
+        Generates hypotheses for several anomaly reports with a single LLM request.
+        Returns one hypothesis dictionary per report, in the same order as `reports`.
+        """
+        if len(reports) == 1:
+            return [await self._generate_hypothesis(reports[0])]
+
+        self.log(f"Generating causal hypotheses for {len(reports)} reports with one LLM request...")
+        prompt = "Anomaly Reports:\n"
+        for idx, report in enumerate(reports):
+            prompt += f"[{idx}] '{report}'\n"
+        prompt += "What is the suspected upstream system for each report?"
+
+        hypotheses = [{"suspected_system": "Unknown"} for _ in reports]
+        try:
+            async with _LLM_SEMAPHORE:
+                reply = await self.backend.chat_json(
+                    self.model, [{'role': 'system', 'content': _BATCH_HYPOTHESIS_SYS_PROMPT}, {'role': 'user', 'content': prompt}],
+                    options=_BATCH_HYPOTHESIS_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE, schema=_BATCH_HYPOTHESIS_SCHEMA
+                )
+            for item in reply["hypotheses"]:
+                if 0 <= item["idx"] < len(reports):
+                    hypotheses[item["idx"]] = {"suspected_system": item["suspected_system"]}
+            self.log(f"LLM Hypotheses: {hypotheses}")
+        except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+            self.log(f"FATAL ERROR parsing LLM hypotheses response. Error: {e}")
+        except Exception as e:
+            self.log(f"A connection error occurred with the LLM backend: {e}")
+        return hypotheses
+
     def _is_hypothesis_valid(self, hypothesis_proposition):
         """Checks if a potential new belief violates any loaded expert rules."""
         if not self.expert_rules:
             return True
 
-        hypothetical_model = self.kripke_model.copy()
-        current_world_valuations = hypothetical_model.valuations.setdefault(hypothetical_model.current_world, set())
-        current_world_valuations.add(hypothesis_proposition)
-
-        for rule in self.expert_rules:
-            if not self.modal_parser.check(hypothetical_model, rule):
-                self.log(f"HYPOTHESIS REJECTED: It violates expert rule -> '{rule}'")
-                return False
+        # Temporarily add the hypothesis to the live model instead of copying the whole model,
+        # and roll the change back once the rules have been checked.
+        valuations = self.kripke_model.valuations
+        world = self.kripke_model.current_world
+        original_valuation = valuations.get(world)
+        valuations[world] = (original_valuation or frozenset()) | {hypothesis_proposition}
+        try:
+            for rule, rule_fn in self._compiled_rules:
+                if not rule_fn(self.kripke_model):
+                    self.log(f"HYPOTHESIS REJECTED: It violates expert rule -> '{rule}'")
+                    return False
+        finally:
+            if original_valuation is None:
+                del valuations[world]
+            else:
+                valuations[world] = original_valuation
 
         self.log(f"Hypothesis '{hypothesis_proposition}' is consistent with all expert rules.")
         return True
 
-    def _get_causal_theory_from_llm(self, reports, connection_context):
+    async def _get_causal_theory_from_llm(self, reports, connection_context):
         """Uses LLM to synthesize reports into a single causal theory."""
         self.log("Synthesizing reports into a causal theory using LLM...")
-        system_prompt = """
-        You are a master diagnostics engine for a particle accelerator. Based on the following agent reports,
-        determine the most likely causal chain. Use the provided physical connection context to determine the correct
-        causal direction (a component providing a service is the upstream cause). Your response MUST be a JSON object
-        with three keys:
-        "root_cause_agent": The name of the agent reporting the root cause.
-        "symptom_agent": The name of the agent reporting the downstream symptom.
-        "causal_theory": A brief, human-readable explanation of the failure chain.
-        """
         prompt = "Synthesize these reports into a single root cause theory:\n"
         for agent_name, details in reports.items():
             prompt += f"- Report from '{agent_name}': {details['anomaly_report']}. Suspected cause: '{details.get('suspected_system', 'None')}'.\n"
@@ -127,64 +385,44 @@ class NeuroSymbolicAgent:
         if connection_context:
             prompt += f"\n{connection_context}\n"
 
+        cache_key = (frozenset((agent_name, details.get('suspected_system')) for agent_name, details in reports.items()),
+                     connection_context)
+        if cache_key in self._theory_cache:
+            self.log("Reusing cached causal theory for the same set of reports.")
+            return self._theory_cache[cache_key]
+
         try:
-            response = self.client.chat(
-                model=self.model,
-                messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}],
-                format='json'
-            )
-            raw_content = response['message']['content']
-            theory = json.loads(raw_content)
+            async with _LLM_SEMAPHORE:
+                theory = await self.backend.chat_json(
+                    self.model, [{'role': 'system', 'content': _THEORY_SYS_PROMPT}, {'role': 'user', 'content': prompt}],
+                    options=_THEORY_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE, schema=_THEORY_SCHEMA
+                )
             self.log(f"LLM Causal Theory: {theory}")
+            self._theory_cache[cache_key] = theory
             return theory
         except Exception as e:
             self.log(f"FATAL ERROR getting causal theory from LLM. Error: {e}")
             return None
 
-    def diagnose_system_state(self, reports, lattice_agent):
+    async def diagnose_system_state(self, reports, lattice_agent):
         """Analyzes all reports to form, validate, and verify a causal hypothesis."""
         if len(reports) < 2:
             return []  # Cannot correlate a single report
 
-        agent_to_component_map = {
-            "Cooling_Agent": "COOL:primary_loop",
-            "Klystron_Agent": "RF:klystron",
-            "RF_Agent": "RF:cavity",
-            "Vacuum_Agent": "VAC:sector1_pump"
-        }
-        agent_to_pv_map = {
-            "Cooling_Agent": "COOL:valve_position",
-            "Klystron_Agent": "RF:klystron_output",
-            "RF_Agent": "RF:cavity",
-            "Vacuum_Agent": "VAC:sector1_pump:pressure"
-        }
-        connection_type_map = {
-            "Cooling_Agent": "cooling",
-            "Klystron_Agent": "power"
-        }
+        # A theory can only be confirmed if the lattice connects one reporter to another. `reachable` returns
+        # the component names downstream of a reporter, and these are compared with the other reporters'
+        # lattice keys, which `_try_theory` uses as downstream component names. One cached reachability
+        # pass per reporter thus rules out uncorrelated reports before asking the LLM.
+        lattice_keys = {_lattice_key(agent) for agent in reports} - {None}
+        if not any(lattice_agent.knowledge_base.reachable(key) & lattice_keys for key in lattice_keys):
+            self.log("No reporting components are linked in the lattice. The reports are likely uncorrelated.")
+            return []
 
         # Build a context string from the lattice model to help the LLM with causality.
-        reporting_agents = list(reports.keys())
-        involved_components = [agent_to_component_map.get(agent) for agent in reporting_agents if
-                               agent in agent_to_component_map]
-        connection_context = ""
-
-        if len(involved_components) >= 2:
-            context_lines = ["For context, here are the known physical connections which imply causal direction:"]
-            for comp1_name, comp2_name in combinations(involved_components, 2):
-                comp1_details = lattice_agent.knowledge_base.layout.get(comp1_name, {})
-                comp2_details = lattice_agent.knowledge_base.layout.get(comp2_name, {})
-                if comp2_name in comp1_details.get("services", []):
-                    context_lines.append(
-                        f"- The '{comp1_name}' component provides a service to the '{comp2_name}' component.")
-                if comp1_name in comp2_details.get("services", []):
-                    context_lines.append(
-                        f"- The '{comp2_name}' component provides a service to the '{comp1_name}' component.")
-            if len(context_lines) > 1:
-                connection_context = "\n".join(context_lines)
+        connection_context = _CAUSAL_CONTEXT.get(frozenset(reports).intersection(_AGENT_TO_COMPONENT), "")
 
         # Stage 1: Hypothesize (Neural)
-        theory = self._get_causal_theory_from_llm(reports, connection_context)
+        theory = await self._get_causal_theory_from_llm(reports, connection_context)
         if not theory or "root_cause_agent" not in theory or "symptom_agent" not in theory:
             self.log("LLM failed to produce a valid causal theory.")
             return []
@@ -197,63 +435,60 @@ class NeuroSymbolicAgent:
             return []
 
         # Stage 2 & 3: Validate and Verify
-        proposition = f"{root_agent.split('_')[0].lower()}_fault_reported"
-        if not self._is_hypothesis_valid(proposition):
+        validity = {}  # Expert-rule verdicts per proposition, shared by both directions
+        confirmed = self._try_theory(root_agent, symptom_agent, lattice_agent, validity)
+        if confirmed:
+            self.log(f"SUCCESS: Root cause confirmed. Theory: {theory['causal_theory']}")
+            await self.update_kripke_model(theory['causal_theory'], "DiagnosticsEngine")
+            return [root_agent, symptom_agent]
+        if confirmed is None:
             return []
 
-        upstream_pv = agent_to_pv_map.get(root_agent)
-        downstream_pv = agent_to_pv_map.get(symptom_agent)
-        conn_type = connection_type_map.get(root_agent, "unknown")
+        # --- SELF-CORRECTION LOGIC ---
+        self.log("Lattice check failed. The proposed causal link is not physically possible.")
+        self.log("ATTEMPTING TO REVERSE CAUSAL THEORY...")
+
+        # Swap the agents
+        root_agent, symptom_agent = symptom_agent, root_agent
+        confirmed = self._try_theory(root_agent, symptom_agent, lattice_agent, validity, reversed_theory=True)
+        if confirmed:
+            corrected_theory_text = (
+                f"After reversing the LLM's initial theory, the corrected root cause is {root_agent} "
+                f"and the symptom is {symptom_agent}. This is physically plausible.")
+            self.log(f"SUCCESS: Reversed root cause confirmed. Theory: {corrected_theory_text}")
+            await self.update_kripke_model(corrected_theory_text, "DiagnosticsEngine")
+            return [root_agent, symptom_agent]
+        if confirmed is False:
+            self.log("Reversed lattice check also failed. The reports are likely uncorrelated.")
+        return []
+
+    def _try_theory(self, root_agent, symptom_agent, lattice_agent, validity, reversed_theory=False):
+        """
+        Validates a causal link against the expert rules (Stage 2) and verifies it against the lattice (Stage 3).
+        Returns True if the link is confirmed, False if the lattice rejects it, and None if it could not be
+        checked at all (rule violation or unmapped agents). `validity` caches rule verdicts by proposition.
+        """
+        proposition = f"{root_agent.split('_')[0].lower()}_fault_reported"
+        if proposition not in validity:
+            validity[proposition] = self._is_hypothesis_valid(proposition)
+        if not validity[proposition]:
+            if reversed_theory:
+                self.log("Reversed hypothesis failed symbolic validation.")
+            return None
+
+        upstream_pv = _lattice_key(root_agent)
+        downstream_pv = _lattice_key(symptom_agent)
+        conn_type = _CONN_TYPE.get(root_agent, "unknown")
 
         if not upstream_pv or not downstream_pv:
-            self.log("Could not map agents from theory to known PVs for lattice check.")
-            return []
+            theory_kind = "reversed theory" if reversed_theory else "theory"
+            self.log(f"Could not map agents from {theory_kind} to known PVs for lattice check.")
+            return None
 
         query = {"check_connection": {"upstream": upstream_pv, "downstream": downstream_pv, "type": conn_type}}
         response = lattice_agent.process_query(query, self.name)
-        self.log(f"LATTICE CHECK: {response['details']}")
-
-        if response['status'] == 'affirmative':
-            self.log(f"SUCCESS: Root cause confirmed. Theory: {theory['causal_theory']}")
-            self.update_kripke_model(theory['causal_theory'], "DiagnosticsEngine")
-            return [root_agent, symptom_agent]
-        else:
-            # --- SELF-CORRECTION LOGIC ---
-            self.log("Lattice check failed. The proposed causal link is not physically possible.")
-            self.log("ATTEMPTING TO REVERSE CAUSAL THEORY...")
-
-            # Swap the agents
-            root_agent, symptom_agent = symptom_agent, root_agent
-
-            # STAGE 2 (REPEATED): Validate the reversed hypothesis
-            proposition = f"{root_agent.split('_')[0].lower()}_fault_reported"
-            if not self._is_hypothesis_valid(proposition):
-                self.log("Reversed hypothesis failed symbolic validation.")
-                return []
-
-            # STAGE 3 (REPEATED): Verify the reversed hypothesis
-            upstream_pv = agent_to_pv_map.get(root_agent)
-            downstream_pv = agent_to_pv_map.get(symptom_agent)
-            conn_type = connection_type_map.get(root_agent, "unknown")
-
-            if not upstream_pv or not downstream_pv:
-                self.log("Could not map agents from reversed theory to known PVs for lattice check.")
-                return []
-
-            query = {"check_connection": {"upstream": upstream_pv, "downstream": downstream_pv, "type": conn_type}}
-            response = lattice_agent.process_query(query, self.name)
-            self.log(f"REVERSED LATTICE CHECK: {response['details']}")
-
-            if response['status'] == 'affirmative':
-                corrected_theory_text = (
-                    f"After reversing the LLM's initial theory, the corrected root cause is {root_agent} "
-                    f"and the symptom is {symptom_agent}. This is physically plausible.")
-                self.log(f"SUCCESS: Reversed root cause confirmed. Theory: {corrected_theory_text}")
-                self.update_kripke_model(corrected_theory_text, "DiagnosticsEngine")
-                return [root_agent, symptom_agent]
-            else:
-                self.log("Reversed lattice check also failed. The reports are likely uncorrelated.")
-                return []
+        self.log(f"{'REVERSED ' if reversed_theory else ''}LATTICE CHECK: {response['details']}")
+        return response['status'] == 'affirmative'
 
     def process_query(self, query, sender):
         """
@@ -262,30 +497,25 @@ class NeuroSymbolicAgent:
         self.log(f"Received query from {sender}: '{query}'")
         if self.name == "LatticeLayoutAgent" and "check_connection" in query:
             params = query["check_connection"]
+            # The lattice model memoizes its answers, so repeated checks are dictionary lookups.
             connection_result = self.knowledge_base.are_components_connected(
                 params["upstream"], params["downstream"], params.get("type", "cooling")
             )
-            response = {
+            return {
                 "status": "affirmative" if connection_result["connected"] else "negative",
                 "details": connection_result["reason"]
             }
-            return response
         return {"status": "unknown", "details": "I cannot answer this query."}
 
-    def update_kripke_model(self, new_info, sender):
+    async def update_kripke_model(self, new_info, sender):
         """
         Updates the agent's Kripke model based on new information, using the LLM.
         """
         self.log(f"Updating beliefs with info from {sender}: '{new_info}'")
-        system_prompt = """
-        You are a precise reasoning engine. Your task is to update a Kripke model based on new, definitive information.
-        You MUST prune worlds and relations that are now impossible.
-        Respond ONLY with the complete, updated Kripke model in a single JSON object.
-        The 'valuations' property must be a dictionary where each value is a LIST OF STRINGS.
-        """
+        self._theory_cache.clear()
         prompt = f"""
         Current Kripke Model:
-        {json.dumps(self.kripke_model.to_dict(), indent=2)}
+        {orjson.dumps(self.kripke_model.to_dict(), option=orjson.OPT_INDENT_2).decode()}
 
         New Information from agent {sender}:
         "{new_info}"
@@ -294,30 +524,28 @@ class NeuroSymbolicAgent:
         """
         raw_content = ""
         try:
-            response = self.client.chat(
-                model=self.model,
-                messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}],
-                format='json'
-            )
-            raw_content = response['message']['content']
-            updated_model_dict = json.loads(raw_content)
+            async with _LLM_SEMAPHORE:
+                raw_content = await self.backend.chat(
+                    self.model, [{'role': 'system', 'content': _UPDATE_SYS_PROMPT}, {'role': 'user', 'content': prompt}],
+                    options=_UPDATE_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE, schema=_UPDATE_SCHEMA
+                )
+            updated_model_dict = orjson.loads(raw_content)
 
-            updated_valuations = {w: set(p) for w, p in updated_model_dict.get("valuations", {}).items()}
             self.kripke_model = KripkeModel(
                 updated_model_dict.get("worlds", []),
                 {tuple(r) for r in updated_model_dict.get("relations", [])},
-                updated_valuations,
+                updated_model_dict.get("valuations", {}),
                 updated_model_dict.get("current_world", "")
             )
-        except (json.JSONDecodeError, TypeError, KeyError) as e:
+        except (orjson.JSONDecodeError, TypeError, KeyError) as e:
             self.log(f"FATAL ERROR parsing LLM Kripke update response. Error: {e}")
             self.log(f"Raw LLM Output: {raw_content}")
         except Exception as e:
-            self.log(f"A connection error occurred with Ollama: {e}")
+            self.log(f"A connection error occurred with the LLM backend: {e}")
 
 
 # --- Agent Factory ---
-def create_agent(agent_type, ollama_model):
+def create_agent(agent_type, ollama_model, backend=None):
     """Factory function to create agents of a specific type."""
     if agent_type == "RF_Agent":
         kripke = KripkeModel(
@@ -326,7 +554,7 @@ def create_agent(agent_type, ollama_model):
             valuations={'w0': {'rf_ok'}, 'w1': {'rf_temp_high'}, 'w2': {'rf_power_low'}}
         )
         return NeuroSymbolicAgent(
-            name="RF_Agent", model=ollama_model, kripke_model=kripke,
+            name="RF_Agent", backend=backend, model=ollama_model, kripke_model=kripke,
             monitored_pvs=["RF:cavity_temp", "RF:forward_power"],
             thresholds={"RF:cavity_temp": (40, 60), "RF:forward_power": (9.5, 10.5)}
         )
@@ -336,7 +564,7 @@ def create_agent(agent_type, ollama_model):
             valuations={'w0': {'cooling_ok'}, 'w1': {'pressure_low', 'cooling_fault_reported'}}
         )
         return NeuroSymbolicAgent(
-            name="Cooling_Agent", model=ollama_model, kripke_model=kripke,
+            name="Cooling_Agent", backend=backend, model=ollama_model, kripke_model=kripke,
             monitored_pvs=["COOL:water_pressure", "COOL:valve_position"],
             thresholds={"COOL:water_pressure": (75, 85), "COOL:valve_position": (95, 105)}
         )
@@ -346,7 +574,7 @@ def create_agent(agent_type, ollama_model):
             valuations={'w0': {'klystron_ok'}, 'w1': {'output_power_low', 'klystron_fault_reported'}}
         )
         return NeuroSymbolicAgent(
-            name="Klystron_Agent", model=ollama_model, kripke_model=kripke,
+            name="Klystron_Agent", backend=backend, model=ollama_model, kripke_model=kripke,
             monitored_pvs=["RF:klystron_output"],
             thresholds={"RF:klystron_output": (90, 110)}
         )
@@ -356,7 +584,7 @@ def create_agent(agent_type, ollama_model):
             valuations={'w0': {'vacuum_ok'}, 'w1': {'pressure_high', 'vacuum_fault_reported'}}
         )
         return NeuroSymbolicAgent(
-            name="Vacuum_Agent", model=ollama_model, kripke_model=kripke,
+            name="Vacuum_Agent", backend=backend, model=ollama_model, kripke_model=kripke,
             monitored_pvs=["VAC:sector1_pump:pressure"],
             thresholds={"VAC:sector1_pump:pressure": (0, 5e-9)}
         )
@@ -375,13 +603,13 @@ def create_agent(agent_type, ollama_model):
         )
         # Pass the expert rules to the diagnostics agent
         return NeuroSymbolicAgent(
-            name="AcceleratorDiagnostics", model=ollama_model, kripke_model=kripke,
+            name="AcceleratorDiagnostics", backend=backend, model=ollama_model, kripke_model=kripke,
             monitored_pvs=[], thresholds={}, expert_rules=EXPERT_RULES
         )
 
     if agent_type == "LatticeLayoutAgent":
         return NeuroSymbolicAgent(
-            name="LatticeLayoutAgent", model=ollama_model, kripke_model=KripkeModel([], set(), {}, ''),
+            name="LatticeLayoutAgent", backend=backend, model=ollama_model, kripke_model=KripkeModel([], set(), {}, ''),
             monitored_pvs=[], thresholds={}, knowledge_base=LatticeModel(LATTICE_LAYOUT)
         )
 
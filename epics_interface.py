@@ -10,8 +10,36 @@ conditions and to introduce specific, sustained anomalies when triggered.
 V2 Update: This version now includes physical coupling. Anomalies in one
 component will realistically affect the PVs of connected downstream components.
 """
-import random
+import logging
+import sys
 import time
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; without it the coupling kernel runs as plain NumPy code.
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+logger = logging.getLogger(__name__)
+
+
+@njit(cache=True, fastmath=True)
+def _apply_coupling(values, base, klystron_idx, fwdpow_idx, cavity_temp_idx,
+                    klystron_fault, cooling_fault, t_cool):
+    """
+    Applies the physical coupling between components to one tick of PV values, in place.
+    Kept free of Python objects so Numba can compile it; the compiled artifact is cached on disk.
+    """
+    # A Klystron fault will cause a drop in the RF forward power.
+    if klystron_fault:
+        # Forward power is now proportional to the klystron's actual output.
+        values[fwdpow_idx] *= values[klystron_idx] / base[klystron_idx]
+    # A cooling fault will cause the RF cavity temperature to rise over time.
+    if cooling_fault:
+        # Simulate thermal inertia: temperature increases each tick the fault is active.
+        values[cavity_temp_idx] += t_cool * 5.0
+    return values
 
 class EpicsSimulator:
     """
@@ -32,67 +60,81 @@ class EpicsSimulator:
             "COOL:water_temp": (22.0, 0.5),
             "COOL:valve_position": (100.0, 0.0) # 100% open
         }
-        self.anomalies = {}
+        self.anomalies = {}  # Active anomaly type per PV
         self.time_since_cooling_fault = 0
-        print("--- EPICS Simulator Initialized (with Physical Coupling) ---")
+
+        # Array view of the PV table so a whole tick is sampled with a few NumPy operations.
+        self._names = [sys.intern(name) for name in self.pvs]
+        self._pv_index = {name: i for i, name in enumerate(self._names)}
+        self._base = np.array([base for base, _ in self.pvs.values()])
+        self._noise = np.array([noise for _, noise in self.pvs.values()])
+        # Active anomalies, aligned with `self._names`: 'low'/'high' scale the value,
+        # 'stuck' replaces it with a fixed reading.
+        self._anom_mult = np.ones(len(self._names))
+        self._anom_stuck_mask = np.zeros(len(self._names), dtype=bool)
+        self._anom_stuck_val = np.full(len(self._names), np.nan)
+        self._rng = np.random.default_rng()
+        self._klystron_idx = self._pv_index['RF:klystron_output']
+        self._fwdpow_idx = self._pv_index['RF:forward_power']
+        self._cavity_temp_idx = self._pv_index['RF:cavity_temp']
+        # Snapshot of the current tick, so every query within a tick sees the same values.
+        self._tick_cache = None
+        logger.info("--- EPICS Simulator Initialized (with Physical Coupling) ---")
 
     def get_pv_value(self, pv_name):
         """
         Returns the current value of a given PV, including noise and any active anomaly.
-        This version includes physical coupling logic.
+        Values come from the snapshot of the current tick, so repeated queries agree with each other
+        and with `get_all_pvs`.
         """
         if pv_name not in self.pvs:
             return None
+        if self._tick_cache is None:
+            self._tick_cache = dict(zip(self._names, self._sample_values().tolist()))
+        return self._tick_cache[pv_name]
 
-        base, noise = self.pvs[pv_name]
-        current_value = base + random.uniform(-noise, noise)
+    def _sample_values(self):
+        """
+        Draws one noisy value for every PV (ordered as `self._names`) and applies the active
+        anomalies and the physical coupling between components.
+        """
+        values = self._base + self._rng.uniform(-self._noise, self._noise)
 
         # --- ANOMALY APPLICATION (Direct Faults) ---
-        if pv_name in self.anomalies:
-            anomaly_type = self.anomalies[pv_name]
-            if anomaly_type == 'low':
-                current_value *= 0.1
-            elif anomaly_type == 'high':
-                current_value *= 1.15
-            elif anomaly_type == 'stuck':
-                current_value = self.anomalies.get(f"{pv_name}_value", base)
+        values = np.where(self._anom_stuck_mask, self._anom_stuck_val, values * self._anom_mult)
 
         # --- PHYSICAL COUPLING (Cascading Faults) ---
-        # A Klystron fault will cause a drop in the RF forward power.
-        if pv_name == 'RF:forward_power' and 'RF:klystron_output' in self.anomalies:
-            klystron_base = self.pvs['RF:klystron_output'][0]
-            klystron_actual = self.get_pv_value('RF:klystron_output')
-            # Forward power is now proportional to the klystron's actual output.
-            current_value *= (klystron_actual / klystron_base)
-
-        # A cooling fault will cause the RF cavity temperature to rise over time.
-        if pv_name == 'RF:cavity_temp' and 'COOL:valve_position' in self.anomalies:
-            # Simulate thermal inertia: temperature increases each tick the fault is active.
-            current_value += (self.time_since_cooling_fault * 5.0)
-
-        return current_value
+        return _apply_coupling(
+            values, self._base, self._klystron_idx, self._fwdpow_idx, self._cavity_temp_idx,
+            'RF:klystron_output' in self.anomalies, 'COOL:valve_position' in self.anomalies,
+            float(self.time_since_cooling_fault)
+        )
 
     def introduce_anomaly(self, pv_name, anomaly_type, value=None):
         """
         Introduces a sustained anomaly to a specific PV.
         """
         if pv_name in self.pvs:
+            idx = self._pv_index[pv_name]
             self.anomalies[pv_name] = anomaly_type
-            if value is not None:
-                self.anomalies[f"{pv_name}_value"] = value
+            self._anom_mult[idx] = {'low': 0.1, 'high': 1.15}.get(anomaly_type, 1.0)
+            self._anom_stuck_mask[idx] = anomaly_type == 'stuck'
+            # A stuck PV without an explicit reading freezes at its normal value.
+            self._anom_stuck_val[idx] = self._base[idx] if value is None else value
+            self._tick_cache = None  # The snapshot no longer reflects the active anomalies
 
             if 'COOL' in pv_name:
                 self.time_since_cooling_fault = 1 # Start the timer for thermal effects
 
-            print(f"\n==================================================")
-            print(f"!!! INTRODUCING ANOMALY: {anomaly_type.upper()} ON {pv_name} !!!")
-            print(f"==================================================\n")
+            logger.info("\n%s\n!!! INTRODUCING ANOMALY: %s ON %s !!!\n%s\n",
+                        "=" * 50, anomaly_type.upper(), pv_name, "=" * 50)
 
 
     def get_all_pvs(self):
         """
-        Returns a dictionary of all current PV values.
+        Advances the simulation by one tick and returns a dictionary of all current PV values.
         """
         if self.time_since_cooling_fault > 0:
             self.time_since_cooling_fault += 1 # Increment timer if cooling fault is active
-        return {pv: self.get_pv_value(pv) for pv in self.pvs}
\ No newline at end of file
+        self._tick_cache = dict(zip(self._names, self._sample_values().tolist()))
+        return dict(self._tick_cache)
\ No newline at end of file
@@ -9,9 +9,15 @@ the physical plausibility of its causal hypotheses. For instance, if an RF agent
 suspects a cooling issue, the diagnostics agent can query this model to confirm
 that the specific RF cavity is indeed serviced by the specific cooling loop in question.
 """
+import functools
+import sys
+from collections import deque
+from collections.abc import Mapping
+from types import MappingProxyType
+import numpy as np
 
 # --- LATTICE LAYOUT DEFINITION ---
-# The lattice is represented as a Python dictionary.
+# The lattice is represented as a Python dictionary (frozen into read-only mappings at import, see below).
 # - Keys: The top-level keys are the EPICS Process Variable (PV) name prefixes,
 #         which uniquely identify each major component (e.g., "RF:cavity").
 # - Values: Each value is another dictionary containing the properties of that component.
@@ -95,6 +101,164 @@ LATTICE_LAYOUT = {
     }
 }
 
+
+def _freeze_layout(layout):
+    """
+    Returns a read-only copy of a layout: dicts become MappingProxyType views, 'services' a frozenset
+    and 'sensors' a tuple. Every component and PV name is passed through `sys.intern`, so the repeated
+    dict lookups and comparisons on these names can short-circuit on identity.
+    """
+    frozen = {}
+    for component_name, details in layout.items():
+        details = dict(details)
+        if "connected_to" in details:
+            details["connected_to"] = MappingProxyType({
+                connection_type: sys.intern(component) for connection_type, component in details["connected_to"].items()
+            })
+        if "services" in details:
+            details["services"] = frozenset(sys.intern(pv) for pv in details["services"])
+        if "sensors" in details:
+            details["sensors"] = tuple(sys.intern(pv) for pv in details["sensors"])
+        frozen[sys.intern(component_name)] = MappingProxyType(details)
+    return MappingProxyType(frozen)
+
+
+# The layout is static at runtime; freezing it keeps agents from mutating the shared knowledge base.
+LATTICE_LAYOUT = _freeze_layout(LATTICE_LAYOUT)
+
+_NO_CONNECTIONS = MappingProxyType({})
+
+# Naming-convention fallbacks for sensor PVs not listed in any component's 'sensors':
+# (substring of the PV name, owning component), checked in order.
+_SENSOR_FALLBACKS = (
+    ("COOL:water_pressure", "COOL:primary_loop"),
+    ("PS:quad_1A", "PS:quad_1A"),
+    ("VAC:sector1_pump", "VAC:sector1_pump"),
+)
+
+
+# Templates for the human-readable reasons of connectivity checks, formatted only when read.
+_REASON_UNKNOWN_UPSTREAM = "Connection check failed: The upstream PV '{}' does not map to a known component in the lattice model."
+_REASON_UNKNOWN_DOWNSTREAM = "Connection check failed: The downstream component '{}' does not exist in the lattice model."
+_REASON_CONNECTED_TO = "Connection verified: The downstream component '{}' explicitly lists '{}' as its '{}' source."
+_REASON_SERVICES = "Connection verified: The upstream component '{}' lists '{}' in its services."
+_REASON_NOT_CONNECTED = "Connection check failed: No physical '{}' connection was found between the upstream component '{}' and the downstream component '{}' in the lattice model."
+
+
+class _ConnResult(Mapping):
+    """
+    Read-only result of a connectivity check, used like the dict {'connected': ..., 'reason': ...}.
+    The reason string is only formatted when it is first read, then kept for later reads.
+    """
+    __slots__ = ('connected', '_fmt', '_args', '_reason')
+    _KEYS = ('connected', 'reason')
+
+    def __init__(self, connected, fmt, *args):
+        self.connected = connected
+        self._fmt = fmt
+        self._args = args
+        self._reason = None
+
+    def __getitem__(self, key):
+        if key == 'connected':
+            return self.connected
+        if key == 'reason':
+            if self._reason is None:
+                self._reason = self._fmt.format(*self._args)
+            return self._reason
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+
+class CSRLattice:
+    """
+    A compressed-sparse-row view of the lattice's connection graph.
+
+    Every component (including ones only referenced by other components, such as "BL:1")
+    and every connection type gets an integer id. The outgoing edges of component `u`
+    (upstream -> downstream) are `indices[indptr[u]:indptr[u + 1]]`, sorted by target id,
+    with the matching connection type ids in `etype`. A 'connected_to' entry becomes an
+    edge of its connection type; a 'services' entry becomes an edge of type SERVICE.
+    """
+    SERVICE = -1
+
+    def __init__(self, layout):
+        edges = set()
+        self.component_ids = {}
+        self.connection_type_ids = {}
+        for name, details in layout.items():
+            down = self._component_id(name)
+            for connection_type, upstream in details.get("connected_to", _NO_CONNECTIONS).items():
+                type_id = self.connection_type_ids.setdefault(connection_type, len(self.connection_type_ids))
+                edges.add((self._component_id(upstream), down, type_id))
+            for downstream in details.get("services", ()):
+                edges.add((down, self._component_id(downstream), self.SERVICE))
+
+        # Sorting by (upstream, downstream) gives the row blocks and keeps each row sorted by target.
+        edges = sorted(edges)
+        counts = np.bincount([up for up, _, _ in edges], minlength=len(self.component_ids))
+        self.indptr = np.zeros(len(self.component_ids) + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = np.array([down for _, down, _ in edges], dtype=np.int32)
+        self.etype = np.array([type_id for _, _, type_id in edges], dtype=np.int8)
+        self.component_names = list(self.component_ids)  # Indexed by component id
+
+    def _component_id(self, name):
+        return self.component_ids.setdefault(name, len(self.component_ids))
+
+    def _edge_types(self, upstream, downstream):
+        """Returns the connection type ids of all edges upstream -> downstream (empty if none)."""
+        up = self.component_ids.get(upstream)
+        down = self.component_ids.get(downstream)
+        if up is None or down is None:
+            return self.etype[:0]
+        start, end = self.indptr[up], self.indptr[up + 1]
+        row = self.indices[start:end]
+        lo = start + np.searchsorted(row, down, side="left")
+        hi = start + np.searchsorted(row, down, side="right")
+        return self.etype[lo:hi]
+
+    def has_edge(self, upstream, downstream, connection_type):
+        """True if `downstream` lists `upstream` as its `connection_type` source."""
+        type_id = self.connection_type_ids.get(connection_type)
+        return type_id is not None and bool((self._edge_types(upstream, downstream) == type_id).any())
+
+    def services(self, upstream, downstream):
+        """True if `upstream` lists `downstream` in its services."""
+        return bool((self._edge_types(upstream, downstream) == self.SERVICE).any())
+
+    def downstream_of(self, component, connection_type=None):
+        """
+        Breadth-first search along the edges leaving `component`. Returns the names of all components
+        it reaches, following every edge, or only `connection_type` and service edges if a type is given.
+        """
+        start = self.component_ids.get(component)
+        if start is None:
+            return frozenset()
+        allowed = None
+        if connection_type is not None:
+            allowed = {self.SERVICE, self.connection_type_ids.get(connection_type)}
+
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            up = queue.popleft()
+            for edge in range(self.indptr[up], self.indptr[up + 1]):
+                if allowed is not None and self.etype[edge] not in allowed:
+                    continue
+                down = int(self.indices[edge])
+                if down not in seen:
+                    seen.add(down)
+                    queue.append(down)
+        seen.discard(start)
+        return frozenset(self.component_names[down] for down in seen)
+
+
 class LatticeModel:
     """
     An interface to the accelerator's physical layout knowledge base.
@@ -107,9 +271,20 @@ class LatticeModel:
         """
         Initializes the LatticeModel with a specific layout structure.
         Args:
-            layout (dict): The LATTICE_LAYOUT dictionary defining the accelerator structure.
+            layout (Mapping): The LATTICE_LAYOUT mapping defining the accelerator structure.
         """
         self.layout = layout
+        # Reverse index from each sensor PV to the component that owns it, built once.
+        self._sensor_to_component = {
+            sensor: component_name
+            for component_name, details in layout.items()
+            for sensor in details.get("sensors", ())
+        }
+        # Integer adjacency arrays, so both connectivity checks are binary searches over a component's edges.
+        self._csr = CSRLattice(layout)
+        # The layout does not change at runtime, so query results are memoized per instance.
+        self._cached_connection_check = functools.lru_cache(maxsize=None)(self._check_connection)
+        self.reachable = functools.lru_cache(maxsize=None)(self.reachable)
 
     def are_components_connected(self, upstream_component_pv_prefix, downstream_component_pv_prefix, connection_type="cooling"):
         """
@@ -123,45 +298,52 @@ class LatticeModel:
             connection_type (str): The type of connection to check (e.g., 'cooling', 'power', 'vacuum').
 
         Returns:
-            dict: A dictionary with a 'connected' boolean and a 'reason' string.
+            Mapping: A read-only dict-like result with a 'connected' boolean and a 'reason' string.
+        """
+        # Results are immutable, so the cached object can be shared between callers.
+        return self._cached_connection_check(
+            sys.intern(upstream_component_pv_prefix), sys.intern(downstream_component_pv_prefix), connection_type
+        )
+
+    def reachable(self, pv, connection_type=None):
+        """
+        Returns every component downstream of the component that owns the sensor PV `pv`, through any
+        chain of physical connections (restricted to `connection_type` and service links if given).
+        A direct connection found by `are_components_connected` always lies within this set.
+
+        Returns:
+            frozenset: Names of the reachable components; empty if `pv` maps to no known component.
         """
+        component = self._find_component_by_sensor(pv)
+        if not component:
+            return frozenset()
+        return self._csr.downstream_of(component, connection_type)
+
+    def _check_connection(self, upstream_component_pv_prefix, downstream_component_pv_prefix, connection_type):
+        """Uncached implementation of `are_components_connected`."""
         # First, find the actual parent component for the upstream PV (e.g., 'COOL:water_pressure' -> 'COOL:primary_loop').
         upstream_component = self._find_component_by_sensor(upstream_component_pv_prefix)
         if not upstream_component:
-            return {
-                "connected": False,
-                "reason": f"Connection check failed: The upstream PV '{upstream_component_pv_prefix}' does not map to a known component in the lattice model."
-            }
+            return _ConnResult(False, _REASON_UNKNOWN_UPSTREAM, upstream_component_pv_prefix)
 
 
-        downstream_info = self.layout.get(downstream_component_pv_prefix)
-        if not downstream_info:
-            return {
-                "connected": False,
-                "reason": f"Connection check failed: The downstream component '{downstream_component_pv_prefix}' does not exist in the lattice model."
-            }
+        if not self.layout.get(downstream_component_pv_prefix):
+            return _ConnResult(False, _REASON_UNKNOWN_DOWNSTREAM, downstream_component_pv_prefix)
 
         # Logic Check 1: Does the downstream component explicitly state it is connected to the upstream component?
-        connection = downstream_info.get("connected_to", {}).get(connection_type)
-        if connection == upstream_component:
-            return {
-                "connected": True,
-                "reason": f"Connection verified: The downstream component '{downstream_component_pv_prefix}' explicitly lists '{upstream_component}' as its '{connection_type}' source."
-            }
+        if self._csr.has_edge(upstream_component, downstream_component_pv_prefix, connection_type):
+            return _ConnResult(
+                True, _REASON_CONNECTED_TO, downstream_component_pv_prefix, upstream_component, connection_type
+            )
 
         # Logic Check 2: Does the upstream component explicitly state it services the downstream component?
-        services = self.layout.get(upstream_component, {}).get("services", [])
-        if downstream_component_pv_prefix in services:
-            return {
-                "connected": True,
-                "reason": f"Connection verified: The upstream component '{upstream_component}' lists '{downstream_component_pv_prefix}' in its services."
-            }
+        if self._csr.services(upstream_component, downstream_component_pv_prefix):
+            return _ConnResult(True, _REASON_SERVICES, upstream_component, downstream_component_pv_prefix)
 
         # If neither check passes, they are not connected in the specified way.
-        return {
-            "connected": False,
-            "reason": f"Connection check failed: No physical '{connection_type}' connection was found between the upstream component '{upstream_component}' and the downstream component '{downstream_component_pv_prefix}' in the lattice model."
-        }
+        return _ConnResult(
+            False, _REASON_NOT_CONNECTED, connection_type, upstream_component, downstream_component_pv_prefix
+        )
 
 
     def _find_component_by_sensor(self, sensor_pv):
@@ -169,18 +351,17 @@ class LatticeModel:
         A helper method to find the parent component that owns a specific sensor PV.
         For example, given "COOL:water_pressure", this should return "COOL:primary_loop".
         """
-        # Iterate through all known components in the layout.
-        for component_name, details in self.layout.items():
-            # Check if the sensor PV is listed in this component's 'sensors' list.
-            if sensor_pv in details.get("sensors", []):
-                return component_name
+        # Look the sensor PV up in the reverse index of all components' 'sensors' lists.
+        component_name = self._sensor_to_component.get(sensor_pv)
+        if component_name:
+            return component_name
 
         # If the sensor is not explicitly listed, use a fallback heuristic.
         # This is a simplification for the simulation, assuming a naming convention.
         # In a real system, this mapping would be more robust.
-        if "COOL:water_pressure" in sensor_pv: return "COOL:primary_loop"
-        if "PS:quad_1A" in sensor_pv: return "PS:quad_1A"
-        if "VAC:sector1_pump" in sensor_pv: return "VAC:sector1_pump"
+        for pv_fragment, fallback_component in _SENSOR_FALLBACKS:
+            if pv_fragment in sensor_pv:
+                return fallback_component
 
         # If no parent component can be found, return None.
         return None
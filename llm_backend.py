@@ -0,0 +1,186 @@
+# FILE: llm_backend.py
+
+"""
+Chat backends for the language model used by the agents.
+
+The agents only need one operation from the LLM: send a short conversation and
+get a JSON reply back. This module hides the concrete inference server behind a
+small common interface so the agents do not depend on a particular client API.
+
+- OllamaBackend talks to a local Ollama server (the default).
+- VLLMBackend talks to a vLLM OpenAI-compatible server. vLLM's continuous batching
+  and PagedAttention pack the concurrent, structurally identical agent requests of a
+  simulation tick into shared forward passes. Launch it with, for example:
+      python -m vllm.entrypoints.openai.api_server --model <model> --enable-prefix-caching --max-num-seqs 64
+
+Generation options are given in Ollama's vocabulary ('num_predict', 'temperature',
+'top_k', ...) and translated by each backend as needed. A JSON schema can be passed
+to constrain decoding, so the reply is guaranteed to parse and to have the expected keys.
+
+Agents should share one backend per server (see `shared_backend`) so that all of
+their requests reuse a single pool of keep-alive HTTP connections.
+
+Replies are streamed and the stream is closed as soon as a complete JSON object has
+arrived, so the tokens a model emits after the closing brace are never waited for.
+"""
+import importlib.util
+import httpx
+import ollama
+import orjson
+
+# HTTP/2 multiplexing needs the optional 'h2' package; keep-alive HTTP/1.1 is used otherwise.
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_SHARED_BACKENDS = {}
+
+
+class _JSONObjectScanner:
+    """
+    Incrementally tracks brace depth over streamed text (ignoring braces inside string
+    literals) to detect the end of the first top-level JSON object.
+    """
+
+    def __init__(self):
+        self.end = None  # Offset just past the closing brace, once seen
+        self._offset = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        """Consumes the next piece of text; returns True once the object is complete."""
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}' and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = self._offset + i + 1
+                    return True
+        self._offset += len(text)
+        return False
+
+
+async def _collect_json_stream(pieces):
+    """
+    Accumulates streamed text until the first JSON object is complete, then stops reading.
+    If no complete object is detected, the full text is returned for the caller to parse.
+    """
+    scanner = _JSONObjectScanner()
+    content = ""
+    async for piece in pieces:
+        content += piece
+        if scanner.feed(piece):
+            return content[:scanner.end]
+    return content
+
+
+class LLMBackend:
+    """Common interface for the chat-completion servers used by the agents."""
+
+    async def chat(self, model, messages, options=None, keep_alive=None, schema=None):
+        """
+        Sends a chat request in JSON mode and returns the raw text content of the reply.
+        If `schema` (a JSON schema dict) is given, the server constrains generation to match it.
+        """
+        raise NotImplementedError
+
+    async def chat_json(self, model, messages, options=None, keep_alive=None, schema=None):
+        """Sends a chat request in JSON mode and returns the decoded reply."""
+        return orjson.loads(await self.chat(model, messages, options=options, keep_alive=keep_alive, schema=schema))
+
+    async def preload(self, model, keep_alive=None):
+        """Loads the model ahead of the first request. A no-op for servers that always keep it resident."""
+
+    async def aclose(self):
+        """Closes the backend's HTTP connections."""
+
+
+class OllamaBackend(LLMBackend):
+    """Backend for a local Ollama server."""
+
+    def __init__(self, host=None):
+        self.client = ollama.AsyncClient(
+            host=host, timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=32), http2=_HTTP2
+        )
+
+    async def chat(self, model, messages, options=None, keep_alive=None, schema=None):
+        stream = await self.client.chat(
+            model=model, messages=messages, format=schema or 'json', options=options, keep_alive=keep_alive,
+            stream=True
+        )
+        try:
+            return await _collect_json_stream(chunk['message']['content'] or "" async for chunk in stream)
+        finally:
+            await stream.aclose()  # Stops the generation on the server if we returned early
+
+    async def preload(self, model, keep_alive=None):
+        # An empty conversation makes Ollama load the model without generating anything.
+        await self.client.chat(model=model, messages=[], keep_alive=keep_alive)
+
+    async def aclose(self):
+        await self.client.close()
+
+
+class VLLMBackend(LLMBackend):
+    """Backend for a vLLM (or any other OpenAI-compatible) server."""
+
+    def __init__(self, base_url, api_key="EMPTY"):
+        # The OpenAI client is only required when a vLLM server is actually used.
+        from openai import AsyncOpenAI
+        self.client = AsyncOpenAI(base_url=base_url.rstrip('/') + '/v1', api_key=api_key)
+
+    async def chat(self, model, messages, options=None, keep_alive=None, schema=None):
+        # 'keep_alive' and the context options are server-side settings for vLLM.
+        options = options or {}
+        request = {}
+        extra_body = {}
+        if 'num_predict' in options:
+            request["max_tokens"] = options['num_predict']
+        if 'temperature' in options:
+            request["temperature"] = options['temperature']
+        if 'top_k' in options:
+            extra_body["top_k"] = options['top_k']
+        # vLLM accepts only one kind of guided decoding per request: the schema, or plain JSON mode without one.
+        if schema:
+            extra_body["guided_json"] = schema
+        else:
+            request["response_format"] = {"type": "json_object"}
+        if extra_body:
+            request["extra_body"] = extra_body
+        stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **request)
+        try:
+            return await _collect_json_stream(
+                chunk.choices[0].delta.content or "" async for chunk in stream if chunk.choices
+            )
+        finally:
+            await stream.close()  # Aborts the request on the server if we returned early
+
+    async def aclose(self):
+        await self.client.close()
+
+
+def shared_backend(vllm_base_url=None):
+    """
+    Returns the process-wide backend for a server, creating it on first use: the local Ollama
+    server by default, or the vLLM server at `vllm_base_url`.
+    """
+    if vllm_base_url not in _SHARED_BACKENDS:
+        _SHARED_BACKENDS[vllm_base_url] = VLLMBackend(vllm_base_url) if vllm_base_url else OllamaBackend()
+    return _SHARED_BACKENDS[vllm_base_url]
+
+
+async def close_all():
+    """Closes every shared backend; call once when the simulation shuts down."""
+    while _SHARED_BACKENDS:
+        _, backend = _SHARED_BACKENDS.popitem()
+        await backend.aclose()
@@ -6,15 +6,30 @@ selected scenario, and runs a step-by-step simulation of a fault occurring and
 the agents collaborating to diagnose it.
 """
 
-import time
-import json
+import asyncio
+import logging
+import os
+import sys
+import orjson
 from epics_interface import EpicsSimulator
-from agents import create_agent
+from agents import create_agent, preload_model
+from llm_backend import close_all, shared_backend
 from scenarios import get_scenarios
 
 # --- Simulation Configuration ---
 OLLAMA_MODEL = 'phi3' # Recommended: 'llama3' or other capable model
+# For faster decoding, prefer a Q4_K_M quantized tag, e.g. 'phi3:3.8b-mini-4k-instruct-q4_K_M'.
 SIMULATION_SPEED = 1  # Seconds per tick
+# Set VLLM_BASE_URL (e.g. 'http://localhost:8000') to use a vLLM server instead of Ollama.
+# VLLM_MODEL must then name the model the server was launched with.
+VLLM_BASE_URL = os.environ.get("VLLM_BASE_URL")
+VLLM_MODEL = os.environ.get("VLLM_MODEL", OLLAMA_MODEL)
+# Agent and simulator output level. DEBUG also dumps every agent's Kripke model;
+# WARNING silences the per-tick agent logs entirely.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# The single-line "EPICS State:" JSON (read by scenario_plot.py) is always printed;
+# SIM_VERBOSE=0 drops the additional indented dump of the state.
+SIM_VERBOSE = bool(int(os.environ.get("SIM_VERBOSE", "1")))
 
 def print_header(title):
     """Prints a formatted header to the console."""
@@ -22,7 +37,7 @@ def print_header(title):
     print(f"--- {title.upper()} ---")
     print("="*60)
 
-def main():
+async def main():
     """Main function to run the simulation."""
     scenarios = get_scenarios()
 
@@ -44,62 +59,89 @@ def main():
     print(f"INFO: Expected outcome: {selected_scenario['expected_outcome']}")
 
     # 1. Initialize the environment and agents
-    epics = EpicsSimulator()
-    agents = {name: create_agent(name, OLLAMA_MODEL) for name in selected_scenario['agents_to_create']}
-    diagnostics_agent = agents.get("AcceleratorDiagnostics")
-    lattice_agent = agents.get("LatticeLayoutAgent")
-    unresolved_reports = {} # Diagnostics agent's memory
-
-    # --- Simulation Loop ---
-    for i in range(1, 8): # Run for 7 ticks
-        print_header(f"Simulation Tick {i}")
-
-        # Introduce anomalies scheduled for this tick
-        for anomaly in selected_scenario['anomalies_to_introduce']:
-            if anomaly['tick'] == i:
-                epics.introduce_anomaly(anomaly['pv_name'], anomaly['type'], anomaly.get('value'))
-
-        epics_state = epics.get_all_pvs()
-        print(f"EPICS State: {json.dumps(epics_state, indent=2)}")
-
-        # 2. Component agents check signals and report
-        new_reports_this_tick = []
-        for agent in agents.values():
-            if agent.name not in ["AcceleratorDiagnostics", "LatticeLayoutAgent"]:
-                report = agent.check_signals(epics_state)
+    try:
+        # All agents share one backend, and with it one pool of keep-alive HTTP connections.
+        backend = shared_backend(VLLM_BASE_URL)
+        model = VLLM_MODEL if VLLM_BASE_URL else OLLAMA_MODEL
+        await preload_model(backend, model)
+        epics = EpicsSimulator()
+        agents = {name: create_agent(name, model, backend) for name in selected_scenario['agents_to_create']}
+        diagnostics_agent = agents.get("AcceleratorDiagnostics")
+        lattice_agent = agents.get("LatticeLayoutAgent")
+        unresolved_reports = {} # Diagnostics agent's memory
+
+        # --- Simulation Loop ---
+        for i in range(1, 8): # Run for 7 ticks
+            print_header(f"Simulation Tick {i}")
+
+            # Introduce anomalies scheduled for this tick
+            for anomaly in selected_scenario['anomalies_to_introduce']:
+                if anomaly['tick'] == i:
+                    epics.introduce_anomaly(anomaly['pv_name'], anomaly['type'], anomaly.get('value'))
+
+            epics_state = epics.get_all_pvs()
+            print(f"EPICS State: {orjson.dumps(epics_state).decode()}")
+            if SIM_VERBOSE:
+                print(orjson.dumps(epics_state, option=orjson.OPT_INDENT_2).decode())
+
+            # 2. Component agents check signals and report
+            new_reports_this_tick = []
+            monitoring_agents = [agent for agent in agents.values()
+                                 if agent.name not in ["AcceleratorDiagnostics", "LatticeLayoutAgent"]]
+            if diagnostics_agent:
+                # Agents only detect breaches; the diagnostics agent resolves all hypotheses in one LLM request.
+                anomalies = [(agent, agent.detect_anomaly(epics_state)) for agent in monitoring_agents]
+                anomalies = [(agent, anomaly) for agent, anomaly in anomalies if anomaly]
+                hypotheses = await diagnostics_agent.hypotheses_for_anomalies(
+                    [anomaly for _, anomaly in anomalies]) if anomalies else []
+                agent_reports = [(agent, {"anomaly_report": anomaly['anomaly_report'], **hypothesis})
+                                 for (agent, anomaly), hypothesis in zip(anomalies, hypotheses)]
+            else:
+                # Without an orchestrator, each agent queries the LLM itself; the calls run concurrently.
+                tasks = [agent.check_signals(epics_state) for agent in monitoring_agents]
+                agent_reports = zip(monitoring_agents, await asyncio.gather(*tasks))
+            for agent, report in agent_reports:
                 if report:
                     agent.log(f"Generating report: {report['anomaly_report']}")
                     new_reports_this_tick.append({"sender": agent.name, **report})
 
-        # 3. Diagnostics agent receives and analyzes reports
-        if diagnostics_agent and lattice_agent and new_reports_this_tick:
-            print_header("Diagnostics Agent Analysis")
-            diagnostics_agent.log("Analyzing new reports...")
-            # Add new reports to memory
-            for r in new_reports_this_tick:
-                unresolved_reports[r['sender']] = r
-
-            # --- DYNAMIC, AGENT-DRIVEN REASONING LOGIC ---
-            # The agent itself now performs the diagnosis.
-            resolved_agents = diagnostics_agent.diagnose_system_state(unresolved_reports, lattice_agent)
-
-            # Clear any reports that the agent has now successfully diagnosed.
-            if resolved_agents:
-                diagnostics_agent.log(f"Clearing resolved reports from agents: {resolved_agents}")
-                for agent_name in resolved_agents:
-                    if agent_name in unresolved_reports:
-                        del unresolved_reports[agent_name]
-
-        time.sleep(SIMULATION_SPEED)
-
-    print_header("Simulation Complete")
-    if diagnostics_agent:
-        diagnostics_agent.print_kb()
-        if unresolved_reports:
-            print("\n--- Unresolved Faults ---")
-            for agent_name, report_details in unresolved_reports.items():
-                print(f"Agent '{agent_name}' reported an unresolved anomaly: {report_details['anomaly_report']}")
+            # 3. Diagnostics agent receives and analyzes reports
+            if diagnostics_agent and lattice_agent and new_reports_this_tick:
+                print_header("Diagnostics Agent Analysis")
+                diagnostics_agent.log("Analyzing new reports...")
+                # Add new reports to memory
+                for r in new_reports_this_tick:
+                    unresolved_reports[r['sender']] = r
+
+                # --- DYNAMIC, AGENT-DRIVEN REASONING LOGIC ---
+                # The agent itself now performs the diagnosis.
+                resolved_agents = await diagnostics_agent.diagnose_system_state(unresolved_reports, lattice_agent)
+
+                # Clear any reports that the agent has now successfully diagnosed.
+                if resolved_agents:
+                    diagnostics_agent.log(f"Clearing resolved reports from agents: {resolved_agents}")
+                    for agent_name in resolved_agents:
+                        if agent_name in unresolved_reports:
+                            del unresolved_reports[agent_name]
+
+            await asyncio.sleep(SIMULATION_SPEED)
+
+        print_header("Simulation Complete")
+        if diagnostics_agent:
+            diagnostics_agent.print_kb(logging.INFO)
+            if unresolved_reports:
+                print("\n--- Unresolved Faults ---")
+                for agent_name, report_details in unresolved_reports.items():
+                    print(f"Agent '{agent_name}' reported an unresolved anomaly: {report_details['anomaly_report']}")
+    finally:
+        # Close the pooled HTTP connections even if the run is interrupted.
+        await close_all()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Log to stdout like the rest of the output, so redirected runs keep a single ordered log.
+    # LOG_LEVEL only applies to our own modules; libraries such as httpx stay at WARNING.
+    logging.basicConfig(level=logging.WARNING, format="%(message)s", handlers=[logging.StreamHandler(sys.stdout)])
+    for module_name in ("agents", "epics_interface"):
+        logging.getLogger(module_name).setLevel(LOG_LEVEL)
+    asyncio.run(main())
\ No newline at end of file
@@ -4,8 +4,10 @@ a parser for modal logic formulas and a class for Kripke models, which represent
 the belief states of the agents.
 """
 from lark import Lark, Transformer, v_args
+import functools
 import json
-import copy as python_copy
+
+_EMPTY = frozenset()
 
 # A standard grammar for propositional modal logic
 MODAL_GRAMMAR = """
@@ -52,8 +54,14 @@ class KripkeModel:
     def __init__(self, worlds, relations, valuations, current_world='w0'):
         self.worlds = set(worlds)
         self.relations = set(relations)
-        self.valuations = valuations
+        # Valuations are frozen, so proposition checks never allocate; replace a world's set to change it.
+        self.valuations = {w: frozenset(p) for w, p in valuations.items()}
+        self._empty = _EMPTY
         self.current_world = current_world
+        # Adjacency list of the accessibility relation, so modal operators need not scan every relation.
+        self._succ = {}
+        for w, u in self.relations:
+            self._succ.setdefault(w, []).append(u)
 
     def to_dict(self):
         """Serializes the model to a dictionary for JSON output."""
@@ -66,13 +74,12 @@ class KripkeModel:
         }
 
     def copy(self):
-        """Creates a deep copy of the model for hypothetical reasoning."""
-        return KripkeModel(
-            python_copy.deepcopy(self.worlds),
-            python_copy.deepcopy(self.relations),
-            python_copy.deepcopy(self.valuations),
-            python_copy.deepcopy(self.current_world)
-        )
+        """
+        Creates an independent copy of the model for hypothetical reasoning.
+        World names, propositions and the frozen valuation sets are immutable, so only the
+        containers are copied; the constructor already copies them.
+        """
+        return KripkeModel(self.worlds, self.relations, self.valuations, self.current_world)
 
 def evaluate(model: KripkeModel, world: str, formula: tuple) -> bool:
     """
@@ -80,7 +87,7 @@ def evaluate(model: KripkeModel, world: str, formula: tuple) -> bool:
     """
     op = formula[0]
     if op == 'proposition':
-        return formula[1] in model.valuations.get(world, set())
+        return formula[1] in model.valuations.get(world, model._empty)
     elif op == 'negation':
         return not evaluate(model, world, formula[1])
     elif op == 'conjunction':
@@ -92,12 +99,57 @@ def evaluate(model: KripkeModel, world: str, formula: tuple) -> bool:
     elif op == 'equivalence':
         return evaluate(model, world, formula[1]) == evaluate(model, world, formula[2])
     elif op == 'necessity': # "[]p" - p is true in all accessible worlds
-        accessible = [u for w, u in model.relations if w == world]
+        accessible = model._succ.get(world)
         if not accessible: return True # Vacuously true
-        return all(evaluate(model, u, formula[1]) for u in accessible)
+        sub = formula[1]
+        for u in accessible:
+            if not evaluate(model, u, sub): return False # Stop at the first counterexample
+        return True
     elif op == 'possibility': # "<>p" - p is true in at least one accessible world
-        accessible = [u for w, u in model.relations if w == world]
-        return any(evaluate(model, u, formula[1]) for u in accessible)
+        accessible = model._succ.get(world)
+        if not accessible: return False
+        sub = formula[1]
+        for u in accessible:
+            if evaluate(model, u, sub): return True # Stop at the first witness
+        return False
+    raise TypeError(f"Unknown formula type: {op}")
+
+
+def compile_formula(formula: tuple):
+    """
+    Lowers a formula AST to a Python closure `f(model, world) -> bool`.
+    The AST is walked only once, so repeated checks skip the per-node operator dispatch of `evaluate`.
+    """
+    op = formula[0]
+    if op == 'proposition':
+        name = formula[1]
+        return lambda model, world: name in model.valuations.get(world, _EMPTY)
+    if op == 'negation':
+        sub = compile_formula(formula[1])
+        return lambda model, world: not sub(model, world)
+    if op in ('conjunction', 'disjunction', 'implication', 'equivalence'):
+        left, right = compile_formula(formula[1]), compile_formula(formula[2])
+        if op == 'conjunction':
+            return lambda model, world: left(model, world) and right(model, world)
+        if op == 'disjunction':
+            return lambda model, world: left(model, world) or right(model, world)
+        if op == 'implication':
+            return lambda model, world: not left(model, world) or right(model, world)
+        return lambda model, world: left(model, world) == right(model, world)
+    if op == 'necessity': # Vacuously true when no world is accessible
+        sub = compile_formula(formula[1])
+        def necessity(model, world):
+            for u in model._succ.get(world, ()):
+                if not sub(model, u): return False # Stop at the first counterexample
+            return True
+        return necessity
+    if op == 'possibility':
+        sub = compile_formula(formula[1])
+        def possibility(model, world):
+            for u in model._succ.get(world, ()):
+                if sub(model, u): return True # Stop at the first witness
+            return False
+        return possibility
     raise TypeError(f"Unknown formula type: {op}")
 
 
@@ -105,11 +157,25 @@ class ModalParser:
     """A parser that can check the truth of a modal logic formula against a Kripke model."""
     def __init__(self):
         self.parser = Lark(MODAL_GRAMMAR, parser='lalr', transformer=ModalTransformer())
+        # Tuple ASTs are immutable, so each formula string only needs to be parsed once.
+        self._parse_cached = functools.lru_cache(maxsize=256)(self.parser.parse)
+        self._cache = {} # formula string -> compiled closure `f(model, world)`
 
     def parse(self, text):
-        return self.parser.parse(text)
+        return self._parse_cached(text)
+
+    def _compiled(self, formula_str: str):
+        """Returns the compiled closure for a formula, parsing and compiling it only on first use."""
+        compiled = self._cache.get(formula_str)
+        if compiled is None:
+            compiled = self._cache[formula_str] = compile_formula(self.parse(formula_str))
+        return compiled
+
+    def compile(self, formula_str: str):
+        """Parses a formula once and returns a callable that checks it in the current world of a model."""
+        compiled = self._compiled(formula_str)
+        return lambda model: compiled(model, model.current_world)
 
     def check(self, model: KripkeModel, formula_str: str) -> bool:
         """Checks if a formula is true in the current world of the model."""
-        ast = self.parse(formula_str)
-        return evaluate(model, model.current_world, ast)
\ No newline at end of file
+        return self._compiled(formula_str)(model, model.current_world)
\ No newline at end of file
@@ -1,57 +1,98 @@
 import re
 import json
+import mmap
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
 
+# The variables of interest and their plot titles/labels
+VARIABLES_TO_PLOT = {
+    'COOL:valve_position': 'Cooling Valve Position (%)',
+    'RF:cavity_temp': 'RF Cavity Temperature (°C)',
+    'RF:klystron_output': 'Klystron Output Power (%)',
+    'RF:forward_power': 'RF Forward Power (kW)',
+    'VAC:sector1_pump:pressure': 'Vacuum Pump Pressure (Torr)'
+}
+# Only these columns are kept from each EPICS state; PVs missing from a state become NaN.
+LOG_COLUMNS = ['tick', *VARIABLES_TO_PLOT]
+
+# Tick headers and EPICS State markers, matched directly against the memory-mapped log.
+LOG_MARKER_RE = re.compile(rb'--- SIMULATION TICK (\d+) ---|EPICS State:\s*(?=\{)')
+# Braces and whole string literals, so braces inside JSON strings are skipped by the scanner.
+JSON_STRUCTURE_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}]')
+
+
+def _json_object_end(buf, start):
+    """Returns the offset just past the JSON object starting at `start`, or None if it never closes."""
+    depth = 0
+    for token in JSON_STRUCTURE_RE.finditer(buf, start):
+        if token.group() == b'{':
+            depth += 1
+        elif token.group() == b'}':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return None
 
-def parse_log_file(filepath):
-    """Parses a simulation log file to extract EPICS state data for each tick."""
-    with open(filepath, 'r') as f:
-        content = f.read()
-
-    # Find all EPICS State blocks
-    epics_blocks = re.findall(r'--- SIMULATION TICK (\d+) ---\n.*?EPICS State: ({.*?})', content, re.DOTALL)
 
+def parse_log_file(filepath):
+    """
+    Parses a simulation log file to extract EPICS state data for each tick.
+    The file is memory-mapped and scanned for tick headers; the JSON object following the next
+    'EPICS State:' marker after each header is sliced out by brace matching, then decoded.
+    """
     data = []
-    for tick_str, json_str in epics_blocks:
-        tick = int(tick_str)
-        try:
-            state_dict = json.loads(json_str)
-            state_dict['tick'] = tick
-            data.append(state_dict)
-        except json.JSONDecodeError as e:
-            print(f"Warning: Could not parse JSON in {os.path.basename(filepath)} at tick {tick}. Error: {e}")
-            continue
-
-    return pd.DataFrame(data)
+    if os.path.getsize(filepath) == 0:
+        return pd.DataFrame.from_records(data, columns=LOG_COLUMNS)
+
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        tick = None  # Tick whose EPICS State has not been read yet
+        json_end = 0  # Markers inside an already decoded JSON object are ignored
+        for marker in LOG_MARKER_RE.finditer(mm):
+            if marker.start() < json_end:
+                continue
+            if marker.group(1) is not None:
+                tick = int(marker.group(1))
+                continue
+            if tick is None:
+                continue
+
+            json_end = _json_object_end(mm, marker.end())
+            if json_end is None:
+                print(f"Warning: Unterminated JSON in {os.path.basename(filepath)} at tick {tick}.")
+                break
+            try:
+                state_dict = json.loads(mm[marker.end():json_end])
+                data.append((tick, *(state_dict.get(var, float('nan')) for var in VARIABLES_TO_PLOT)))
+            except json.JSONDecodeError as e:
+                print(f"Warning: Could not parse JSON in {os.path.basename(filepath)} at tick {tick}. Error: {e}")
+            tick = None
+
+    return pd.DataFrame.from_records(data, columns=LOG_COLUMNS)
 
 
 def plot_scenarios(scenarios_data):
     """Generates and saves a plot comparing key variables across scenarios."""
-
-    # Define the variables of interest and their plot titles/labels
-    variables_to_plot = {
-        'COOL:valve_position': 'Cooling Valve Position (%)',
-        'RF:cavity_temp': 'RF Cavity Temperature (°C)',
-        'RF:klystron_output': 'Klystron Output Power (%)',
-        'RF:forward_power': 'RF Forward Power (kW)',
-        'VAC:sector1_pump:pressure': 'Vacuum Pump Pressure (Torr)'
-    }
-
+    variables_to_plot = VARIABLES_TO_PLOT
     num_vars = len(variables_to_plot)
     fig, axes = plt.subplots(num_vars, 1, figsize=(10, 2.5 * num_vars), sharex=True)
     fig.suptitle('Process Variable Evolution Across Scenarios', fontsize=16, y=0.99)
 
-    for i, (var, title) in enumerate(variables_to_plot.items()):
-        ax = axes[i]
-        for name, df in scenarios_data.items():
-            if not df.empty and var in df.columns:
-                ax.plot(df['tick'], df[var], marker='o', linestyle='-', label=name)
+    # Reshape all scenarios once into long form: one row per (scenario, tick, variable).
+    long_data = pd.concat(
+        [df.assign(scenario=name) for name, df in scenarios_data.items()]
+    ).melt(id_vars=['tick', 'scenario'], value_vars=list(variables_to_plot))
+    by_variable = dict(tuple(long_data.groupby('variable', sort=False)))
+
+    for ax, (var, title) in zip(axes, variables_to_plot.items()):
+        var_data = by_variable.get(var)
+        if var_data is not None:
+            for name, group in var_data.groupby('scenario', sort=False):
+                ax.plot(group['tick'].values, group['value'].values, marker='o', linestyle='-', label=name)
 
         # Add anomaly lines
         ax.axvline(x=3, color='r', linestyle='--', linewidth=1, label='Anomaly Start')
-        if name == 'Scenario 3':
+        if 'Scenario 3' in scenarios_data:
             ax.axvline(x=4, color='orange', linestyle='--', linewidth=1, label='Vacuum Anomaly')
 
         ax.set_ylabel(title)